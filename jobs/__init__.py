@@ -1 +1,8 @@
 from .api import *  # noqa
+from .hooks import Hook  # noqa
+from .hooks import SlowTaskProfiler  # noqa
+from .hooks import SpanEmitter  # noqa
+from .hooks import TimingRecorder  # noqa
+from .storage import DBStore  # noqa
+from .storage import FileStore  # noqa
+from .storage import PayloadStore  # noqa
@@ -1,3 +1,8 @@
+from .hooks import Hook
+from .hooks import notify
+from .hooks import timed
+from .storage import DBStore
+from .storage import PayloadStore
 from .utils import resolve_dotted_name
 
 import asyncpg
@@ -17,6 +22,11 @@ async def publish(
     timeout: float = 60,
     priority: int = None,
     max_retries: int = 3,
+    depends_on: typing.List[str] = None,
+    group_id: str = None,
+    after_group: str = None,
+    queue: str = "default",
+    store: PayloadStore = None,
 ):
     """Publish a message.
 
@@ -31,6 +41,15 @@ async def publish(
     timeout -- max timeout in seconds for the task default = 60s
     priority -- priority on the queue
     max_retries -- maximum retries allowed for the task
+    depends_on -- list of job_ids that must be acked before this task
+        can be consumed. If one of them fails, this task fails too.
+    group_id -- tag the task as member of a group (fan-out)
+    after_group -- wait for every pending task of the group (fan-in),
+        publish it after all the group members. Fails to publish if a
+        member already failed, like depends_on.
+    queue -- named queue where the task is published (default="default")
+    store -- PayloadStore where bodies over its threshold are offloaded,
+        the queue row only keeps a reference to them.
     body -- use it instead of (args and kwargs) to just put something
         on the task queue.
         Using *args and **kwargs both get serialized using json on
@@ -39,24 +58,37 @@ async def publish(
     """
     if not body:
         body = json.dumps({"args": args, "kwargs": kwargs})
+    if store is not None:
+        body = await store.offload(db, body)
     # todo not sure if we should serialize to json body
     result = await db.fetchrow(
-        "select * from jobs.publish($1, $2, $3, $4, $5, $6)",
+        "select * from jobs.publish($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)",
         task,
         body,
         scheduled_at,
         timeout,
         priority,
         max_retries,
+        depends_on,
+        group_id,
+        after_group,
+        queue,
     )
     return result
 
 
-async def publish_bulk(db: asyncpg.Connection, jobs):
+async def publish_bulk(
+    db: asyncpg.Connection,
+    jobs,
+    queue: str = "default",
+    store: PayloadStore = None,
+):
     """Publish a batch of jobs:
 
     Arguments:
     db -- asyncpg.Connection
+    queue -- named queue where the jobs are published
+    store -- PayloadStore to offload large bodies
     jobs -- typing.List of tuples with
         [
             (
@@ -72,23 +104,80 @@ async def publish_bulk(db: asyncpg.Connection, jobs):
         the list of created tasks
 
     """
+    if store is not None:
+        jobs = [
+            (job[0], await store.offload(db, job[1])) + tuple(job[2:])
+            for job in jobs
+        ]
     return await db.fetch(
-        "SELECT * FROM jobs.publish_bulk($1::jobs.bulk_job[])", jobs
+        "SELECT * FROM jobs.publish_bulk($1::jobs.bulk_job[], $2)", jobs, queue
     )
 
 
-async def consume(db: asyncpg.Connection, n: int = 1):
+async def create_queue(db: asyncpg.Connection, queue: str):
+    """Give a named queue its own partition (table and indexes).
+
+    Jobs on queues without a partition are stored on a shared one.
+    Attaching the partition locks jobs.job_queue (ACCESS EXCLUSIVE) and
+    scans the shared partition, claims on every queue wait meanwhile.
+    """
+    await db.execute("SELECT jobs.create_queue($1)", queue)
+
+
+async def consume(db: asyncpg.Connection, n: int = 1, queue: str = None):
+    """Claim up to n jobs. Without queue, claims from every queue."""
+    if queue is not None:
+        return await db.fetch(
+            "SELECT * FROM jobs.consume_queue($1, $2)", queue, n
+        )
     return await db.fetch("SELECT * FROM jobs.consume($1)", n)
 
 
-async def consume_topic(db: asyncpg.Connection, topic: str, n: int = 1):
+async def consume_topic(
+    db: asyncpg.Connection, topic: str, n: int = 1, queue: str = None
+):
+    if queue is not None:
+        return await db.fetch(
+            "SELECT * FROM jobs.consume_queue($1, $2, $3)", queue, n, topic
+        )
     return await db.fetch("SELECT * FROM jobs.consume($1, $2)", topic, n)
 
 
-async def ack(db: asyncpg.Connection, task_id: str, result=None):
+async def ack(
+    db: asyncpg.Connection,
+    task_id: str,
+    result=None,
+    store: PayloadStore = None,
+    deferred: bool = False,
+):
+    """Acknowledge a job as done.
+
+    With deferred, the completion is only recorded on jobs.job_done,
+    and `archive` moves it to the jobs history later on. Being unlogged,
+    it's lost on a crash: the job runs again, or is marked failed
+    ("expired") without retries left.
+    """
+    if store is not None:
+        result = await store.offload(db, result)
+    if deferred:
+        return await db.fetchrow(
+            "SELECT * FROM jobs.ack_deferred($1, $2)", task_id, result
+        )
     return await db.fetchrow("SELECT * FROM jobs.ack($1, $2)", task_id, result)
 
 
+async def archive(
+    db: asyncpg.Connection, batch: int = 1000, drop_success: bool = False
+) -> int:
+    """Move a batch of deferred acked jobs to the jobs.job history.
+
+    drop_success -- archive successful jobs without their body and result,
+        keeping just enough to report them done (jobs.get, depends_on)
+    Returns the number of jobs moved.
+    """
+    return await db.fetchval("SELECT jobs.archive($1, $2)", batch, drop_success)
+
+
 async def nack(
     db: asyncpg.Connection,
     task_id: str,
@@ -104,19 +193,52 @@ async def get(db: asyncpg.Connection, task_id):
     return await db.fetchrow("SELECT * from jobs.all where job_id=$1", task_id)
 
 
-async def run(db: asyncpg.Connection, task, sync=False):
+async def run(
+    db: asyncpg.Connection,
+    task,
+    sync=False,
+    store: PayloadStore = None,
+    hooks: typing.List[Hook] = None,
+    deferred: bool = False,
+):
+    """Run a consumed task.
+
+    Offloaded bodies are fetched here, from `store` (or the jobs.payload
+    table when not provided). With sync, the result is acked, also
+    offloaded to `store` when it's too big.
+    `hooks` are notified around the run, with the time spent
+    on every phase (see jobs.hooks).
+    With deferred, the job is acked with `ack(deferred=True)`.
+    """
+    hooks = hooks or []
+    timings: typing.Dict[str, float] = {}
     result = None
+    await notify(hooks, "before_run", task)
     try:
-        func = resolve_dotted_name(task["task"])
-        params = json.loads(task["body"] or "{}")
+        with timed(timings, "resolve"):
+            func = resolve_dotted_name(task["task"])
+        with timed(timings, "deserialize"):
+            params = json.loads(task["body"] or "{}")
+            params = await (store or DBStore()).load(db, params)
         args = params.get("args") or []
         kwargs = params.get("kwargs") or {}
-        result = await func(*args, **kwargs)
+        with timed(timings, "execute"):
+            result = await func(*args, **kwargs)
         if sync:
-            await ack(db, task["job_id"], json.dumps(result))
+            with timed(timings, "serialize"):
+                data = json.dumps(result)
+            with timed(timings, "ack"):
+                await ack(
+                    db, task["job_id"], data, store=store, deferred=deferred
+                )
     except Exception as e:
+        await notify(hooks, "on_error", task, e, timings)
         if sync:
             await nack(db, task["job_id"])
         else:
             raise e
+    else:
+        if sync:
+            await notify(hooks, "on_ack", task, result)
+        await notify(hooks, "after_run", task, result, timings)
     return result
@@ -0,0 +1,128 @@
+import typing
+
+
+def queue_age(job: typing.Mapping[str, typing.Any]) -> float:
+    """Seconds a claimed job waited on the queue before being consumed.
+
+    Computed from server timestamps only (run_at is set by consume).
+    """
+    if job["run_at"] is None or job["created_at"] is None:
+        return 0.0
+    ready = job["created_at"]
+    if job["scheduled_at"] is not None and job["scheduled_at"] > ready:
+        ready = job["scheduled_at"]
+    return max((job["run_at"] - ready).total_seconds(), 0.0)
+
+
+class Autoscaler:
+    """Adapts a worker batch size, concurrency and poll wait to the queue.
+
+    - When consumes come back full and the claim wait (the longest time
+      the claimed jobs waited on the queue) keeps growing, batch size
+      and concurrency are doubled.
+    - When they come back partially filled, both shrink towards the
+      amount of claimed jobs and the worker polls after `min_wait`.
+    - When the queue is empty, batch size and concurrency drop to their
+      minimums and the wait backs off exponentially up to `max_wait`.
+
+    Concurrency never goes over `max_connections - 1`, one connection is
+    kept to consume.
+
+    The claim wait is an approximation of the age of the oldest pending
+    job that costs no extra query. As consumes take the highest priority
+    jobs first, a backlog of old low priority jobs is not reflected on it.
+    """
+
+    def __init__(
+        self,
+        min_batch: int = 1,
+        max_batch: int = 256,
+        max_connections: int = 10,
+        min_wait: float = 0.1,
+        max_wait: float = 10,
+        backoff: float = 2,
+    ):
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.max_connections = max_connections
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.backoff = backoff
+
+        self.batch_size = min_batch
+        self.concurrency = 1
+        self.wait = min_wait
+        self.claim_wait = 0.0
+        self.last_claimed = 0
+        self.consumes = 0
+        self.claimed = 0
+        self.empty_streak = 0
+
+    @property
+    def max_concurrency(self) -> int:
+        return max(self.max_connections - 1, 1)
+
+    def observe(self, tasks: typing.Sequence[typing.Mapping]):
+        """Update the state with the result of a consume"""
+        claimed = len(tasks)
+        previous_wait = self.claim_wait
+        self.claim_wait = max((queue_age(t) for t in tasks), default=0.0)
+        self.last_claimed = claimed
+        self.consumes += 1
+        self.claimed += claimed
+
+        if claimed == 0:
+            self.empty_streak += 1
+            self.batch_size = self.min_batch
+            self.concurrency = 1
+            self.wait = min(
+                self.min_wait * self.backoff**self.empty_streak,
+                self.max_wait,
+            )
+            return
+
+        self.empty_streak = 0
+        if claimed >= self.batch_size:
+            self.wait = 0
+            if self.claim_wait >= previous_wait:
+                self.batch_size = min(self.batch_size * 2, self.max_batch)
+                self.concurrency = min(
+                    self.concurrency * 2, self.max_concurrency
+                )
+        else:
+            self.wait = self.min_wait
+            self.batch_size = max(claimed, self.min_batch)
+            self.concurrency = max(min(self.concurrency, claimed), 1)
+
+    def split(self, parts: int) -> typing.List["Autoscaler"]:
+        """Independent autoscalers for `parts` workers, with the same
+        settings and `max_connections` shared between them"""
+        if self.max_connections < parts:
+            raise ValueError(
+                f"max_connections ({self.max_connections}) is lower than "
+                f"the number of workers ({parts})"
+            )
+        share, extra = divmod(self.max_connections, parts)
+        return [
+            Autoscaler(
+                min_batch=self.min_batch,
+                max_batch=self.max_batch,
+                max_connections=share + (1 if i < extra else 0),
+                min_wait=self.min_wait,
+                max_wait=self.max_wait,
+                backoff=self.backoff,
+            )
+            for i in range(0, parts)
+        ]
+
+    def state(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "wait": self.wait,
+            "claim_wait": self.claim_wait,
+            "last_claimed": self.last_claimed,
+            "consumes": self.consumes,
+            "claimed": self.claimed,
+            "empty_streak": self.empty_streak,
+        }
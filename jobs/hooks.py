@@ -0,0 +1,276 @@
+from contextlib import contextmanager
+
+import bisect
+import collections
+import logging
+import math
+import sys
+import threading
+import time
+import typing
+
+logger = logging.getLogger("jobs")
+
+PHASES = ("claim", "resolve", "deserialize", "execute", "serialize", "ack")
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    math.inf,
+)
+
+
+@contextmanager
+def timed(timings: typing.Dict[str, float], phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+
+class Hook:
+    """Base class for job lifecycle hooks.
+
+    Pass instances on `Worker(hooks=[...])` or `jobs.run(hooks=[...])`.
+    `timings` maps the phases in PHASES to seconds, only the phases
+    already reached are present.
+    """
+
+    async def before_claim(self, queue: typing.Optional[str], n: int):
+        pass
+
+    async def after_claim(self, tasks: typing.List, duration: float):
+        pass
+
+    async def before_run(self, task):
+        pass
+
+    async def after_run(
+        self, task, result: typing.Any, timings: typing.Dict[str, float]
+    ):
+        pass
+
+    async def on_ack(self, task, result: typing.Any):
+        pass
+
+    async def on_error(
+        self, task, error: Exception, timings: typing.Dict[str, float]
+    ):
+        pass
+
+
+async def notify(hooks: typing.Sequence[Hook], event: str, *args):
+    """Calls `event` on every hook, a failing hook is only logged"""
+    for hook in hooks:
+        try:
+            await getattr(hook, event)(*args)
+        except Exception:
+            logger.exception("Hook %s.%s failed", type(hook).__name__, event)
+
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        if not self.buckets or self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        cumulative = 0
+        buckets = {}
+        for bound, amount in zip(self.buckets, self.counts):
+            cumulative += amount
+            buckets[bound] = cumulative
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "buckets": buckets,
+        }
+
+
+class TimingRecorder(Hook):
+    """Keeps in memory histograms of the time spent on every phase"""
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.histograms: typing.Dict[str, Histogram] = collections.defaultdict(
+            lambda: Histogram(buckets)
+        )
+        self.errors = 0
+
+    def record(self, timings: typing.Dict[str, float]):
+        for phase, value in timings.items():
+            self.histograms[phase].observe(value)
+
+    async def after_claim(self, tasks, duration):
+        self.histograms["claim"].observe(duration)
+
+    async def after_run(self, task, result, timings):
+        self.record(timings)
+
+    async def on_error(self, task, error, timings):
+        self.errors += 1
+        self.record(timings)
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        return {
+            phase: histogram.snapshot()
+            for phase, histogram in self.histograms.items()
+        }
+
+
+class SpanEmitter(Hook):
+    """Emits an OpenTelemetry span per job, with the phase timings
+    as attributes.
+
+    Requires `opentelemetry-api`, any tracer provider (and exporter,
+    including the sdk in memory one) can be used.
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                raise ImportError(
+                    "SpanEmitter requires opentelemetry-api, "
+                    "install pgjobs[otel]"
+                )
+            tracer = trace.get_tracer("jobs")
+        self.tracer = tracer
+        self.spans: typing.Dict[str, typing.Any] = {}
+
+    async def before_run(self, task):
+        span = self.tracer.start_span(f"jobs.run {task['task']}")
+        span.set_attribute("jobs.job_id", task["job_id"])
+        span.set_attribute("jobs.task", task["task"])
+        span.set_attribute("jobs.retries", task["retries"] or 0)
+        self.spans[task["job_id"]] = span
+
+    def end(self, task, timings):
+        span = self.spans.pop(task["job_id"], None)
+        if span is not None:
+            for phase, value in timings.items():
+                span.set_attribute(f"jobs.{phase}", value)
+            span.end()
+        return span
+
+    async def after_run(self, task, result, timings):
+        self.end(task, timings)
+
+    async def on_error(self, task, error, timings):
+        span = self.spans.get(task["job_id"])
+        if span is not None:
+            from opentelemetry.trace import Status
+            from opentelemetry.trace import StatusCode
+
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+        self.end(task, timings)
+
+
+class SlowTaskProfiler(Hook):
+    """Opt-in sampling profiler for slow tasks.
+
+    While a job runs, a thread samples the event loop thread stack every
+    `interval` seconds. When executing the job took longer than
+    `threshold`, the most common stacks are logged and kept on `reports`.
+    Samples include any other coroutine running on the same loop.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 1.0,
+        interval: float = 0.005,
+        limit: int = 10,
+        depth: int = 30,
+        max_reports: int = 100,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.limit = limit
+        self.depth = depth
+        self.reports: typing.Deque[typing.Dict[str, typing.Any]] = (
+            collections.deque(maxlen=max_reports)
+        )
+        self._samplers: typing.Dict[str, typing.Tuple] = {}
+
+    def sample(self, ident: int, stop: threading.Event, stacks):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_filename}:{frame.f_lineno} {code.co_name}"
+                )
+                frame = frame.f_back
+            stacks[tuple(stack)] += 1
+
+    async def before_run(self, task):
+        stop = threading.Event()
+        stacks: typing.Counter = collections.Counter()
+        thread = threading.Thread(
+            target=self.sample,
+            args=(threading.get_ident(), stop, stacks),
+            daemon=True,
+        )
+        thread.start()
+        self._samplers[task["job_id"]] = (stop, thread, stacks)
+
+    def finish(self, task, timings):
+        sampler = self._samplers.pop(task["job_id"], None)
+        if sampler is None:
+            return
+        stop, thread, stacks = sampler
+        stop.set()
+        thread.join()
+        elapsed = timings.get("execute", 0.0)
+        if elapsed < self.threshold:
+            return
+        report = {
+            "job_id": task["job_id"],
+            "task": task["task"],
+            "timings": dict(timings),
+            "samples": sum(stacks.values()),
+            "stacks": stacks.most_common(self.limit),
+        }
+        self.reports.append(report)
+        logger.warning(
+            "Slow task %s (%s) %.3fs, top stack: %s",
+            task["task"],
+            task["job_id"],
+            elapsed,
+            report["stacks"][0][0][0] if report["stacks"] else None,
+        )
+
+    async def after_run(self, task, result, timings):
+        self.finish(task, timings)
+
+    async def on_error(self, task, error, timings):
+        self.finish(task, timings)
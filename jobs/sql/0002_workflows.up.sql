@@ -0,0 +1,384 @@
+-- Job chaining (B after A) and fan-out/fan-in (C after A1..An).
+--
+-- Every queued job keeps a counter of parents that have not yet
+-- finished. jobs.ack decrements the counter of its dependents in the
+-- same transaction, so a child becomes claimable as soon as the last
+-- parent is acknowledged. A permanent failure cascades to dependents.
+
+alter table jobs.job_queue
+    add column group_id varchar,
+    add column pending_deps integer not null default 0;
+
+CREATE index idx_job_queue_group_id ON jobs.job_queue(group_id)
+    WHERE group_id IS NOT NULL;
+
+-- kept on the history, so after_group also sees finished members
+alter table jobs.job add column group_id varchar;
+
+CREATE index idx_job_group_id ON jobs.job(group_id)
+    WHERE group_id IS NOT NULL;
+
+create table jobs.job_dependency (
+    job_id varchar(32) not null,
+    depends_on varchar(32) not null,
+    primary key (depends_on, job_id)
+);
+
+
+create or replace view jobs.all as (
+    SELECT
+        id,
+        job_id,
+        task,
+        body,
+        retries,
+        max_retries,
+        CASE WHEN pending_deps > 0 THEN 'waiting'
+            WHEN run_at is null THEN 'pending'
+            ELSE 'running'
+        END as status,
+        priority,
+        timeout,
+        created_at,
+        run_at,
+        scheduled_at,
+        null as complete_on,
+        null as result,
+        null as traceback
+    FROM jobs.job_queue
+        UNION
+    SELECT
+        id,
+        job_id,
+        task,
+        body,
+        retries,
+        max_retries,
+        status::varchar,
+        priority, -- priority
+        timeout,
+        created_at,
+        run_at,
+        scheduled_at,
+        complete_on,
+        result,
+        traceback
+    FROM jobs.job
+);
+
+
+drop function jobs.publish(varchar, jsonb, timestamp, numeric, integer, integer);
+
+create or replace function jobs.publish(
+    i_task varchar,
+    i_body jsonb = null,
+    i_scheduled_at timestamp = null,
+    i_timeout numeric(7,2) =  60,
+    i_priority integer = null,
+    i_max_retries integer = 3,
+    i_depends_on varchar[] = null,
+    i_group_id varchar = null,
+    i_after_group varchar = null
+) returns jobs.job_queue as $$
+DECLARE
+    out jobs.job_queue;
+    parents varchar[];
+    queued varchar[];
+    missing varchar;
+BEGIN
+    parents = coalesce(i_depends_on, '{}'::varchar[]);
+    IF i_after_group IS NOT NULL THEN
+        -- finished members too, so a failed one is an invalid
+        -- dependency as it would be on depends_on
+        parents = parents || ARRAY(
+            SELECT job_id FROM jobs.job_queue WHERE group_id = i_after_group
+            UNION
+            SELECT job_id FROM jobs.job WHERE group_id = i_after_group
+        );
+    END IF;
+
+    -- lock the parents that are still queued, so a concurrent ack
+    -- or nack waits until our dependency rows are visible
+    queued = ARRAY(
+        SELECT DISTINCT job_id FROM (
+            SELECT job_id FROM jobs.job_queue
+            WHERE job_id = ANY(parents)
+            FOR KEY SHARE
+        ) locked
+    );
+
+    -- the others must have finished successfully, checked after the
+    -- lock (fresh snapshot) so a parent failing meanwhile is an error
+    SELECT p FROM unnest(parents) AS p
+        WHERE p <> ALL(queued)
+        AND NOT EXISTS (
+            SELECT 1 FROM jobs.job WHERE job_id = p AND status = 'success'
+        )
+        LIMIT 1
+        INTO missing;
+    IF missing IS NOT NULL THEN
+        raise EXCEPTION 'invalid_dependency %', missing;
+    END IF;
+    parents = queued;
+
+    insert
+        into jobs.job_queue (
+            job_id,
+            task,
+            body,
+            retries,
+            max_retries,
+            priority,
+            timeout,
+            created_at,
+            run_at,
+            scheduled_at,
+            group_id,
+            pending_deps
+        )
+    values (
+        md5(current_time::varchar || i_task || nextval('jobs.job_number')::varchar),
+        i_task,
+        i_body,
+        0,
+        i_max_retries,
+        i_priority,
+        i_timeout,
+        clock_timestamp(),
+        null,
+        i_scheduled_at,
+        i_group_id,
+        coalesce(array_length(parents, 1), 0)
+    ) returning * INTO out;
+
+    INSERT INTO jobs.job_dependency (job_id, depends_on)
+        SELECT out.job_id, p FROM unnest(parents) AS p;
+    return out;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.release_dependents(i_job varchar(32))
+RETURNS void as $$
+BEGIN
+    WITH released AS (
+        DELETE FROM jobs.job_dependency
+            WHERE depends_on = i_job
+            RETURNING job_id
+    )
+    UPDATE jobs.job_queue q
+        SET pending_deps = pending_deps - 1
+        FROM released
+        WHERE q.job_id = released.job_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.fail_dependents(i_job varchar(32))
+RETURNS void as $$
+DECLARE
+    child_id varchar(32);
+    child jobs.job_queue;
+BEGIN
+    FOR child_id IN
+        SELECT job_id FROM jobs.job_dependency
+            WHERE depends_on = i_job
+    LOOP
+        -- a child depending on i_job both directly and through another
+        -- child was already failed by the recursive call, skip it
+        DELETE FROM jobs.job_queue
+            WHERE job_id = child_id
+            RETURNING * INTO child;
+        CONTINUE WHEN NOT FOUND;
+
+        raise INFO 'dependency failed, remove job %', child.job_id;
+        INSERT INTO jobs.job
+        VALUES (
+            child.id,
+            child.job_id,
+            child.task,
+            child.body,
+            child.retries,
+            child.max_retries,
+            child.priority,
+            child.timeout,
+            'failed',
+            child.created_at,
+            child.run_at,
+            child.scheduled_at,
+            now(),
+            null,
+            'dependency_failed ' || i_job,
+            child.group_id
+        );
+        DELETE FROM jobs.job_dependency
+            WHERE job_id = child.job_id;
+        PERFORM jobs.fail_dependents(child.job_id);
+    END LOOP;
+    DELETE FROM jobs.job_dependency
+        WHERE depends_on = i_job;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.ack(
+    i_job varchar(32),
+    i_result jsonb = null
+) returns jobs.job as $$
+DECLARE
+  current jobs.job_queue;
+  dest jobs.job;
+BEGIN
+    SELECT * from jobs.job_queue
+        WHERE job_id=i_job
+        AND run_at IS NOT NULL
+        FOR UPDATE
+        INTO current;
+    -- ensure tasks existss
+    IF current IS NULL THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    raise INFO 'Current %', current;
+    INSERT INTO jobs.job
+        VALUES (
+            current.id,
+            current.job_id,
+            current.task,
+            current.body,
+            current.retries,
+            current.max_retries,
+            current.priority,
+            current.timeout,
+            'success',
+            current.created_at,
+            current.run_at,
+            current.scheduled_at,
+            now(),
+            i_result,
+            null,
+            current.group_id
+        ) RETURNING * INTO dest;
+    DELETE FROM jobs.job_queue
+        WHERE job_id = i_job;
+    PERFORM jobs.release_dependents(i_job);
+    RETURN dest;
+END;
+$$ LANGUAGE plpgsql;
+
+create or replace function jobs.nack(
+    i_job varchar(32),
+    i_traceback text = null,
+    i_scheduled_at timestamp = null,
+    ensure_running boolean = true
+) RETURNS void as $$
+DECLARE
+    current jobs.job_queue;
+BEGIN
+
+    IF ensure_running = true THEN
+        SELECT * from jobs.job_queue
+            WHERE job_id=i_job
+            AND run_at IS NOT NULL
+            FOR UPDATE INTO current;
+    ELSE
+        SELECT * from jobs.job_queue
+            WHERE job_id=i_job
+            FOR UPDATE INTO current;
+    END IF;
+    -- ensure tasks existss
+    IF current IS NULL THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    IF i_scheduled_at IS NULL THEN
+        i_scheduled_at = clock_timestamp() + make_interval(secs=>3*(current.retries+1));
+    END IF;
+
+    IF (current.retries+1) >= current.max_retries THEN
+        raise INFO 'max retries, remove job';
+        INSERT INTO jobs.job
+        VALUES (
+            current.id,
+            current.job_id,
+            current.task,
+            current.body,
+            current.retries,
+            current.max_retries,
+            current.priority,
+            current.timeout,
+            'failed',
+            current.created_at,
+            current.run_at,
+            current.scheduled_at,
+            now(),
+            null,
+            i_traceback,
+            current.group_id
+        );
+        DELETE FROM jobs.job_queue
+            WHERE job_id = i_job;
+        PERFORM jobs.fail_dependents(i_job);
+    ELSE
+        update
+            jobs.job_queue
+        set
+            retries = retries+1,
+            run_at = null,
+            scheduled_at = i_scheduled_at
+        where job_id=i_job;
+    END IF;
+END;
+$$ language plpgsql;
+
+
+create or replace function jobs.consume(num integer)
+    returns SETOF jobs.job_queue as $$
+BEGIN
+    PERFORM jobs.clean_timeout();
+    RETURN QUERY WITH tasks AS (
+        SELECT *
+            from jobs.job_queue
+        WHERE
+            (scheduled_at <= clock_timestamp() OR scheduled_at IS NULL)
+            AND run_at is NULL
+            AND pending_deps = 0
+        ORDER BY priority desc NULLS LAST
+        FOR UPDATE SKIP LOCKED
+        limit num
+    )
+    UPDATE
+        jobs.job_queue
+    SET
+        run_at=now()
+    WHERE id IN (select id from tasks) RETURNING *;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.consume(topic varchar, num integer)
+    RETURNS SETOF jobs.job_queue as $$
+BEGIN
+    PERFORM jobs.clean_timeout();
+    RETURN QUERY WITH tasks AS (
+        SELECT id
+            from jobs.job_queue
+        WHERE
+            (scheduled_at <= clock_timestamp() OR scheduled_at IS NULL)
+            AND run_at is NULL
+            AND pending_deps = 0
+            AND task like topic
+        ORDER BY priority desc NULLS LAST
+        FOR UPDATE SKIP LOCKED
+        limit num
+    ), update AS (
+        UPDATE
+            jobs.job_queue
+        SET
+            run_at=now()
+        WHERE id IN (select id from tasks)
+    ) SELECT * from jobs.job_queue WHERE id IN (
+        SELECT id FROM tasks
+    );
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,542 @@
+-- Named queues.
+--
+-- jobs.job_queue becomes a table list partitioned by queue, so every
+-- queue gets its own heap and indexes, and a backlog on one queue does
+-- not slow down claims on the others. Jobs published without a queue go
+-- to 'default'. Queues without a partition land on job_queue_shared,
+-- until jobs.create_queue gives them their own.
+--
+-- jobs.create_queue attaches a partition, it takes an ACCESS EXCLUSIVE
+-- lock on jobs.job_queue and scans job_queue_shared (the default
+-- partition), blocking claims on every queue while it runs.
+
+drop view jobs.all;
+drop view jobs.expired;
+drop view jobs.running;
+
+drop function jobs.publish_bulk(jobs.bulk_job[]);
+drop function jobs.publish(
+    varchar, jsonb, timestamp, numeric, integer, integer,
+    varchar[], varchar, varchar
+);
+drop function jobs.ack(varchar, jsonb);
+drop function jobs.nack(varchar, text, timestamp, boolean);
+drop function jobs.fail_dependents(varchar);
+drop function jobs.consume(integer);
+drop function jobs.consume(varchar, integer);
+
+-- The existing table is attached as the 'default' partition instead of
+-- being copied: queue is added with a constant default (no rewrite on
+-- PG11), and the check constraint lets the attach skip validating every
+-- row. Only the indexes new to this migration are built.
+alter table jobs.job_queue
+    add column queue varchar not null default 'default',
+    add constraint job_queue_default_queue check (queue = 'default'),
+    drop constraint job_queue_pkey,
+    drop constraint unique_jobqueue_job_id;
+alter table jobs.job_queue rename to job_queue_default;
+alter index jobs.idx_task_name rename to job_queue_default_task_idx;
+alter index jobs.idx_job_queue_group_id
+    rename to job_queue_default_group_id_idx;
+
+create table jobs.job_queue (
+    id integer not null default nextval('jobs.job_queue_id_seq'),
+    job_id varchar(32) not null,
+    task varchar not null,
+    body jsonb,
+    retries integer,
+    max_retries integer default 3,
+    priority integer default 1,
+    timeout numeric(7, 2) default 60,
+    created_at timestamp,
+    run_at timestamp,
+    scheduled_at timestamp,
+    group_id varchar,
+    pending_deps integer not null default 0,
+    queue varchar not null default 'default',
+    primary key (id, queue)
+) partition by list (queue);
+
+alter sequence jobs.job_queue_id_seq owned by jobs.job_queue.id;
+
+alter table jobs.job_queue
+    attach partition jobs.job_queue_default for values in ('default');
+alter table jobs.job_queue_default
+    drop constraint job_queue_default_queue;
+
+create table jobs.job_queue_shared
+    partition of jobs.job_queue default;
+
+-- matching indexes already on job_queue_default are attached, not built
+CREATE index idx_job_queue_task ON jobs.job_queue(task);
+CREATE index idx_job_queue_group_id ON jobs.job_queue(group_id)
+    WHERE group_id IS NOT NULL;
+-- a unique index on a partitioned table must include the partition
+-- key, job_id is only unique per queue (md5 of time and a sequence).
+-- Leading with job_id it also serves the lookups by job_id
+CREATE unique index unique_job_queue_job_id_queue
+    ON jobs.job_queue(job_id, queue);
+CREATE index idx_job_queue_claim ON jobs.job_queue(priority desc NULLS LAST)
+    WHERE run_at IS NULL AND pending_deps = 0;
+CREATE index idx_job_queue_running ON jobs.job_queue(run_at)
+    WHERE run_at IS NOT NULL;
+
+alter table jobs.job
+    add column queue varchar;
+
+
+create or replace function jobs.create_queue(i_queue varchar)
+RETURNS void as $$
+DECLARE
+    part varchar = 'job_queue_' || i_queue;
+BEGIN
+    -- move what was already published on the shared partition.
+    -- Attaching locks jobs.job_queue and scans job_queue_shared, so
+    -- claims on every queue wait until it's done
+    EXECUTE format(
+        'create table jobs.%I (like jobs.job_queue including defaults)',
+        part
+    );
+    EXECUTE format(
+        'with moved as ('
+        '  delete from jobs.job_queue_shared where queue = $1 returning *'
+        ') insert into jobs.%I select * from moved',
+        part
+    ) USING i_queue;
+    EXECUTE format(
+        'alter table jobs.job_queue attach partition jobs.%I for values in (%L)',
+        part,
+        i_queue
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace view jobs.expired as (
+    SELECT *
+    FROM jobs.job_queue
+    WHERE
+        run_at IS NOT NULL
+        AND run_at + make_interval(secs=>timeout) < clock_timestamp()
+);
+
+create or replace view jobs.running as (
+    SELECT * FROM jobs.job_queue
+    WHERE run_at is NOT NULL
+);
+
+create or replace view jobs.all as (
+    SELECT
+        id,
+        job_id,
+        task,
+        body,
+        retries,
+        max_retries,
+        CASE WHEN pending_deps > 0 THEN 'waiting'
+            WHEN run_at is null THEN 'pending'
+            ELSE 'running'
+        END as status,
+        priority,
+        timeout,
+        created_at,
+        run_at,
+        scheduled_at,
+        null as complete_on,
+        null as result,
+        null as traceback,
+        queue
+    FROM jobs.job_queue
+        UNION
+    SELECT
+        id,
+        job_id,
+        task,
+        body,
+        retries,
+        max_retries,
+        status::varchar,
+        priority, -- priority
+        timeout,
+        created_at,
+        run_at,
+        scheduled_at,
+        complete_on,
+        result,
+        traceback,
+        queue
+    FROM jobs.job
+);
+
+
+create or replace function jobs.publish(
+    i_task varchar,
+    i_body jsonb = null,
+    i_scheduled_at timestamp = null,
+    i_timeout numeric(7,2) =  60,
+    i_priority integer = null,
+    i_max_retries integer = 3,
+    i_depends_on varchar[] = null,
+    i_group_id varchar = null,
+    i_after_group varchar = null,
+    i_queue varchar = 'default'
+) returns jobs.job_queue as $$
+DECLARE
+    out jobs.job_queue;
+    parents varchar[];
+    queued varchar[];
+    missing varchar;
+BEGIN
+    parents = coalesce(i_depends_on, '{}'::varchar[]);
+    IF i_after_group IS NOT NULL THEN
+        -- finished members too, so a failed one is an invalid
+        -- dependency as it would be on depends_on
+        parents = parents || ARRAY(
+            SELECT job_id FROM jobs.job_queue WHERE group_id = i_after_group
+            UNION
+            SELECT job_id FROM jobs.job WHERE group_id = i_after_group
+        );
+    END IF;
+
+    -- lock the parents that are still queued, so a concurrent ack
+    -- or nack waits until our dependency rows are visible
+    queued = ARRAY(
+        SELECT DISTINCT job_id FROM (
+            SELECT job_id FROM jobs.job_queue
+            WHERE job_id = ANY(parents)
+            FOR KEY SHARE
+        ) locked
+    );
+
+    -- the others must have finished successfully, checked after the
+    -- lock (fresh snapshot) so a parent failing meanwhile is an error
+    SELECT p FROM unnest(parents) AS p
+        WHERE p <> ALL(queued)
+        AND NOT EXISTS (
+            SELECT 1 FROM jobs.job WHERE job_id = p AND status = 'success'
+        )
+        LIMIT 1
+        INTO missing;
+    IF missing IS NOT NULL THEN
+        raise EXCEPTION 'invalid_dependency %', missing;
+    END IF;
+    parents = queued;
+
+    insert
+        into jobs.job_queue (
+            job_id,
+            task,
+            body,
+            retries,
+            max_retries,
+            priority,
+            timeout,
+            created_at,
+            run_at,
+            scheduled_at,
+            group_id,
+            pending_deps,
+            queue
+        )
+    values (
+        md5(current_time::varchar || i_task || nextval('jobs.job_number')::varchar),
+        i_task,
+        i_body,
+        0,
+        i_max_retries,
+        i_priority,
+        i_timeout,
+        clock_timestamp(),
+        null,
+        i_scheduled_at,
+        i_group_id,
+        coalesce(array_length(parents, 1), 0),
+        coalesce(i_queue, 'default')
+    ) returning * INTO out;
+
+    INSERT INTO jobs.job_dependency (job_id, depends_on)
+        SELECT out.job_id, p FROM unnest(parents) AS p;
+    return out;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.publish_bulk(
+    jobs.bulk_job[],
+    i_queue varchar = 'default'
+)
+returns setof jobs.job_queue as $$
+declare
+  r jobs.bulk_job;
+  result jobs.job_queue;
+BEGIN
+    FOR r in select * from unnest($1) LOOP
+        select * FROM jobs.publish(
+            r.task,
+            r.body,
+            r.scheduled_at,
+            r.timeout,
+            r.priority,
+            r.max_retries,
+            null,
+            null,
+            null,
+            i_queue
+        ) INTO result;
+        RETURN NEXT result;
+    END LOOP;
+    return;
+END;
+$$ language plpgsql;
+
+
+create or replace function jobs.fail_dependents(i_job varchar(32))
+RETURNS void as $$
+DECLARE
+    child_id varchar(32);
+    child jobs.job_queue;
+BEGIN
+    FOR child_id IN
+        SELECT job_id FROM jobs.job_dependency
+            WHERE depends_on = i_job
+    LOOP
+        -- a child depending on i_job both directly and through another
+        -- child was already failed by the recursive call, skip it
+        DELETE FROM jobs.job_queue
+            WHERE job_id = child_id
+            RETURNING * INTO child;
+        CONTINUE WHEN NOT FOUND;
+
+        raise INFO 'dependency failed, remove job %', child.job_id;
+        INSERT INTO jobs.job
+        VALUES (
+            child.id,
+            child.job_id,
+            child.task,
+            child.body,
+            child.retries,
+            child.max_retries,
+            child.priority,
+            child.timeout,
+            'failed',
+            child.created_at,
+            child.run_at,
+            child.scheduled_at,
+            now(),
+            null,
+            'dependency_failed ' || i_job,
+            child.group_id,
+            child.queue
+        );
+        DELETE FROM jobs.job_dependency
+            WHERE job_id = child.job_id;
+        PERFORM jobs.fail_dependents(child.job_id);
+    END LOOP;
+    DELETE FROM jobs.job_dependency
+        WHERE depends_on = i_job;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.ack(
+    i_job varchar(32),
+    i_result jsonb = null
+) returns jobs.job as $$
+DECLARE
+  current jobs.job_queue;
+  dest jobs.job;
+BEGIN
+    SELECT * from jobs.job_queue
+        WHERE job_id=i_job
+        AND run_at IS NOT NULL
+        FOR UPDATE
+        INTO current;
+    -- ensure tasks existss
+    IF current IS NULL THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    raise INFO 'Current %', current;
+    INSERT INTO jobs.job
+        VALUES (
+            current.id,
+            current.job_id,
+            current.task,
+            current.body,
+            current.retries,
+            current.max_retries,
+            current.priority,
+            current.timeout,
+            'success',
+            current.created_at,
+            current.run_at,
+            current.scheduled_at,
+            now(),
+            i_result,
+            null,
+            current.group_id,
+            current.queue
+        ) RETURNING * INTO dest;
+    DELETE FROM jobs.job_queue
+        WHERE queue = current.queue AND job_id = i_job;
+    PERFORM jobs.release_dependents(i_job);
+    RETURN dest;
+END;
+$$ LANGUAGE plpgsql;
+
+create or replace function jobs.nack(
+    i_job varchar(32),
+    i_traceback text = null,
+    i_scheduled_at timestamp = null,
+    ensure_running boolean = true
+) RETURNS void as $$
+DECLARE
+    current jobs.job_queue;
+BEGIN
+
+    IF ensure_running = true THEN
+        SELECT * from jobs.job_queue
+            WHERE job_id=i_job
+            AND run_at IS NOT NULL
+            FOR UPDATE INTO current;
+    ELSE
+        SELECT * from jobs.job_queue
+            WHERE job_id=i_job
+            FOR UPDATE INTO current;
+    END IF;
+    -- ensure tasks existss
+    IF current IS NULL THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    IF i_scheduled_at IS NULL THEN
+        i_scheduled_at = clock_timestamp() + make_interval(secs=>3*(current.retries+1));
+    END IF;
+
+    IF (current.retries+1) >= current.max_retries THEN
+        raise INFO 'max retries, remove job';
+        INSERT INTO jobs.job
+        VALUES (
+            current.id,
+            current.job_id,
+            current.task,
+            current.body,
+            current.retries,
+            current.max_retries,
+            current.priority,
+            current.timeout,
+            'failed',
+            current.created_at,
+            current.run_at,
+            current.scheduled_at,
+            now(),
+            null,
+            i_traceback,
+            current.group_id,
+            current.queue
+        );
+        DELETE FROM jobs.job_queue
+            WHERE queue = current.queue AND job_id = i_job;
+        PERFORM jobs.fail_dependents(i_job);
+    ELSE
+        update
+            jobs.job_queue
+        set
+            retries = retries+1,
+            run_at = null,
+            scheduled_at = i_scheduled_at
+        where queue = current.queue AND job_id=i_job;
+    END IF;
+END;
+$$ language plpgsql;
+
+
+create or replace function jobs.clean_timeout(i_queue varchar)
+RETURNS void as $$
+declare
+    id varchar;
+BEGIN
+    FOR id in select job_id from jobs.expired WHERE queue = i_queue LOOP
+        raise INFO '  cleaned %', id;
+        PERFORM jobs.nack(id, 'expired', ensure_running=>false);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.consume(num integer)
+    returns SETOF jobs.job_queue as $$
+BEGIN
+    PERFORM jobs.clean_timeout();
+    RETURN QUERY WITH tasks AS (
+        SELECT queue, id
+            from jobs.job_queue
+        WHERE
+            (scheduled_at <= clock_timestamp() OR scheduled_at IS NULL)
+            AND run_at is NULL
+            AND pending_deps = 0
+        ORDER BY priority desc NULLS LAST
+        FOR UPDATE SKIP LOCKED
+        limit num
+    )
+    UPDATE
+        jobs.job_queue
+    SET
+        run_at=now()
+    WHERE (queue, id) IN (select queue, id from tasks) RETURNING *;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.consume(topic varchar, num integer)
+    RETURNS SETOF jobs.job_queue as $$
+BEGIN
+    PERFORM jobs.clean_timeout();
+    RETURN QUERY WITH tasks AS (
+        SELECT queue, id
+            from jobs.job_queue
+        WHERE
+            (scheduled_at <= clock_timestamp() OR scheduled_at IS NULL)
+            AND run_at is NULL
+            AND pending_deps = 0
+            AND task like topic
+        ORDER BY priority desc NULLS LAST
+        FOR UPDATE SKIP LOCKED
+        limit num
+    )
+    UPDATE
+        jobs.job_queue
+    SET
+        run_at=now()
+    WHERE (queue, id) IN (select queue, id from tasks) RETURNING *;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.consume_queue(
+    i_queue varchar,
+    num integer,
+    topic varchar = '%'
+) RETURNS SETOF jobs.job_queue as $$
+BEGIN
+    PERFORM jobs.clean_timeout(i_queue);
+    RETURN QUERY WITH tasks AS (
+        SELECT id
+            from jobs.job_queue
+        WHERE
+            queue = i_queue
+            AND (scheduled_at <= clock_timestamp() OR scheduled_at IS NULL)
+            AND run_at is NULL
+            AND pending_deps = 0
+            AND task like topic
+        ORDER BY priority desc NULLS LAST
+        FOR UPDATE SKIP LOCKED
+        limit num
+    )
+    UPDATE
+        jobs.job_queue
+    SET
+        run_at=now()
+    WHERE queue = i_queue AND id IN (select id from tasks) RETURNING *;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,10 @@
+-- Offloaded payloads.
+--
+-- Large bodies and results are stored once here, content addressed,
+-- and the queue row only carries a {"$ref": id} reference to them.
+
+create table jobs.payload (
+    id varchar(64) primary key,
+    data jsonb,
+    created_at timestamp default clock_timestamp()
+);
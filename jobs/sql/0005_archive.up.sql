@@ -0,0 +1,397 @@
+-- Deferred acks and batch archiving.
+--
+-- jobs.ack_deferred only records the completion on the unlogged
+-- jobs.job_done table (and releases dependents), leaving the row on
+-- jobs.job_queue. jobs.archive later moves completed jobs to jobs.job
+-- in batches. With drop_success, successful jobs only keep a slim
+-- history row (no body nor result), so jobs.get and depends_on still
+-- see them as done.
+--
+-- Being unlogged, completions not archived yet are lost on a crash.
+-- Those jobs expire and run again, but the ones without retries left
+-- are marked failed (traceback 'expired') instead. Either way their
+-- dependents are not failed nor held back: releasing them is logged and
+-- already happened.
+
+create unlogged table jobs.job_done (
+    job_id varchar(32) primary key,
+    status jobs.job_status not null,
+    complete_on timestamp,
+    result jsonb,
+    traceback text
+);
+
+
+create or replace view jobs.expired as (
+    SELECT *
+    FROM jobs.job_queue q
+    WHERE
+        run_at IS NOT NULL
+        AND run_at + make_interval(secs=>timeout) < clock_timestamp()
+        AND NOT EXISTS (
+            SELECT 1 FROM jobs.job_done d WHERE d.job_id = q.job_id
+        )
+);
+
+create or replace view jobs.running as (
+    SELECT * FROM jobs.job_queue q
+    WHERE run_at is NOT NULL
+    AND NOT EXISTS (
+        SELECT 1 FROM jobs.job_done d WHERE d.job_id = q.job_id
+    )
+);
+
+drop view jobs.all;
+
+create or replace view jobs.all as (
+    SELECT
+        q.id,
+        q.job_id,
+        q.task,
+        q.body,
+        q.retries,
+        q.max_retries,
+        CASE WHEN d.status IS NOT NULL THEN d.status::varchar
+            WHEN q.pending_deps > 0 THEN 'waiting'
+            WHEN q.run_at is null THEN 'pending'
+            ELSE 'running'
+        END as status,
+        q.priority,
+        q.timeout,
+        q.created_at,
+        q.run_at,
+        q.scheduled_at,
+        d.complete_on,
+        d.result,
+        d.traceback,
+        q.queue
+    FROM jobs.job_queue q
+        LEFT JOIN jobs.job_done d ON d.job_id = q.job_id
+        UNION
+    SELECT
+        id,
+        job_id,
+        task,
+        body,
+        retries,
+        max_retries,
+        status::varchar,
+        priority, -- priority
+        timeout,
+        created_at,
+        run_at,
+        scheduled_at,
+        complete_on,
+        result,
+        traceback,
+        queue
+    FROM jobs.job
+);
+
+
+create or replace function jobs.publish(
+    i_task varchar,
+    i_body jsonb = null,
+    i_scheduled_at timestamp = null,
+    i_timeout numeric(7,2) =  60,
+    i_priority integer = null,
+    i_max_retries integer = 3,
+    i_depends_on varchar[] = null,
+    i_group_id varchar = null,
+    i_after_group varchar = null,
+    i_queue varchar = 'default'
+) returns jobs.job_queue as $$
+DECLARE
+    out jobs.job_queue;
+    parents varchar[];
+    queued varchar[];
+    missing varchar;
+BEGIN
+    parents = coalesce(i_depends_on, '{}'::varchar[]);
+    IF i_after_group IS NOT NULL THEN
+        -- finished members too, so a failed one is an invalid
+        -- dependency as it would be on depends_on
+        parents = parents || ARRAY(
+            SELECT job_id FROM jobs.job_queue WHERE group_id = i_after_group
+            UNION
+            SELECT job_id FROM jobs.job WHERE group_id = i_after_group
+        );
+    END IF;
+
+    -- lock the parents that are still queued, so a concurrent ack
+    -- or nack waits until our dependency rows are visible
+    queued = ARRAY(
+        SELECT DISTINCT job_id FROM (
+            SELECT job_id FROM jobs.job_queue
+            WHERE job_id = ANY(parents)
+            FOR KEY SHARE
+        ) locked
+    );
+
+    -- the others must have finished successfully, checked after the
+    -- lock (fresh snapshot) so a parent failing meanwhile is an error
+    SELECT p FROM unnest(parents) AS p
+        WHERE p <> ALL(queued)
+        AND NOT EXISTS (
+            SELECT 1 FROM jobs.job WHERE job_id = p AND status = 'success'
+        )
+        LIMIT 1
+        INTO missing;
+    IF missing IS NOT NULL THEN
+        raise EXCEPTION 'invalid_dependency %', missing;
+    END IF;
+
+    -- and skip the queued ones acked but not archived yet
+    parents = ARRAY(
+        SELECT p FROM unnest(queued) AS p
+        WHERE NOT EXISTS (
+            SELECT 1 FROM jobs.job_done
+            WHERE job_id = p AND status = 'success'
+        )
+    );
+
+    insert
+        into jobs.job_queue (
+            job_id,
+            task,
+            body,
+            retries,
+            max_retries,
+            priority,
+            timeout,
+            created_at,
+            run_at,
+            scheduled_at,
+            group_id,
+            pending_deps,
+            queue
+        )
+    values (
+        md5(current_time::varchar || i_task || nextval('jobs.job_number')::varchar),
+        i_task,
+        i_body,
+        0,
+        i_max_retries,
+        i_priority,
+        i_timeout,
+        clock_timestamp(),
+        null,
+        i_scheduled_at,
+        i_group_id,
+        coalesce(array_length(parents, 1), 0),
+        coalesce(i_queue, 'default')
+    ) returning * INTO out;
+
+    INSERT INTO jobs.job_dependency (job_id, depends_on)
+        SELECT out.job_id, p FROM unnest(parents) AS p;
+    return out;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.ack(
+    i_job varchar(32),
+    i_result jsonb = null
+) returns jobs.job as $$
+DECLARE
+  current jobs.job_queue;
+  dest jobs.job;
+BEGIN
+    SELECT * from jobs.job_queue
+        WHERE job_id=i_job
+        AND run_at IS NOT NULL
+        FOR UPDATE
+        INTO current;
+    -- ensure tasks existss
+    IF current IS NULL OR EXISTS (
+        SELECT 1 FROM jobs.job_done WHERE job_id = i_job
+    ) THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    raise INFO 'Current %', current;
+    INSERT INTO jobs.job
+        VALUES (
+            current.id,
+            current.job_id,
+            current.task,
+            current.body,
+            current.retries,
+            current.max_retries,
+            current.priority,
+            current.timeout,
+            'success',
+            current.created_at,
+            current.run_at,
+            current.scheduled_at,
+            now(),
+            i_result,
+            null,
+            current.group_id,
+            current.queue
+        ) RETURNING * INTO dest;
+    DELETE FROM jobs.job_queue
+        WHERE queue = current.queue AND job_id = i_job;
+    PERFORM jobs.release_dependents(i_job);
+    RETURN dest;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.ack_deferred(
+    i_job varchar(32),
+    i_result jsonb = null
+) returns jobs.job_done as $$
+DECLARE
+  current jobs.job_queue;
+  dest jobs.job_done;
+BEGIN
+    SELECT * from jobs.job_queue
+        WHERE job_id=i_job
+        AND run_at IS NOT NULL
+        FOR UPDATE
+        INTO current;
+    -- ensure tasks existss
+    IF current IS NULL OR EXISTS (
+        SELECT 1 FROM jobs.job_done WHERE job_id = i_job
+    ) THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    -- unlogged, lost on a crash (see the header), while releasing the
+    -- dependents is logged and survives it
+    INSERT INTO jobs.job_done
+        VALUES (i_job, 'success', now(), i_result, null)
+        RETURNING * INTO dest;
+    PERFORM jobs.release_dependents(i_job);
+    RETURN dest;
+END;
+$$ LANGUAGE plpgsql;
+
+
+create or replace function jobs.nack(
+    i_job varchar(32),
+    i_traceback text = null,
+    i_scheduled_at timestamp = null,
+    ensure_running boolean = true
+) RETURNS void as $$
+DECLARE
+    current jobs.job_queue;
+BEGIN
+
+    IF ensure_running = true THEN
+        SELECT * from jobs.job_queue
+            WHERE job_id=i_job
+            AND run_at IS NOT NULL
+            FOR UPDATE INTO current;
+    ELSE
+        SELECT * from jobs.job_queue
+            WHERE job_id=i_job
+            FOR UPDATE INTO current;
+    END IF;
+    -- ensure tasks existss
+    IF current IS NULL OR EXISTS (
+        SELECT 1 FROM jobs.job_done WHERE job_id = i_job
+    ) THEN
+        raise EXCEPTION 'inexistent_task %', i_job;
+    END IF;
+
+    IF i_scheduled_at IS NULL THEN
+        i_scheduled_at = clock_timestamp() + make_interval(secs=>3*(current.retries+1));
+    END IF;
+
+    IF (current.retries+1) >= current.max_retries THEN
+        raise INFO 'max retries, remove job';
+        INSERT INTO jobs.job
+        VALUES (
+            current.id,
+            current.job_id,
+            current.task,
+            current.body,
+            current.retries,
+            current.max_retries,
+            current.priority,
+            current.timeout,
+            'failed',
+            current.created_at,
+            current.run_at,
+            current.scheduled_at,
+            now(),
+            null,
+            i_traceback,
+            current.group_id,
+            current.queue
+        );
+        DELETE FROM jobs.job_queue
+            WHERE queue = current.queue AND job_id = i_job;
+        PERFORM jobs.fail_dependents(i_job);
+    ELSE
+        update
+            jobs.job_queue
+        set
+            retries = retries+1,
+            run_at = null,
+            scheduled_at = i_scheduled_at
+        where queue = current.queue AND job_id=i_job;
+    END IF;
+END;
+$$ language plpgsql;
+
+
+create or replace function jobs.archive(
+    batch integer = 1000,
+    drop_success boolean = false
+) RETURNS integer as $$
+DECLARE
+    amount integer;
+BEGIN
+    WITH done AS (
+        DELETE FROM jobs.job_done
+            WHERE job_id IN (
+                SELECT job_id FROM jobs.job_done
+                ORDER BY complete_on
+                FOR UPDATE SKIP LOCKED
+                LIMIT batch
+            )
+            RETURNING *
+    ), moved AS (
+        DELETE FROM jobs.job_queue q
+            USING done
+            WHERE q.job_id = done.job_id
+            RETURNING
+                q.*,
+                done.status,
+                done.complete_on,
+                done.result,
+                done.traceback
+    ), archived AS (
+        INSERT INTO jobs.job
+            SELECT
+                id,
+                job_id,
+                task,
+                CASE WHEN dropped THEN null ELSE body END,
+                retries,
+                max_retries,
+                priority,
+                timeout,
+                status,
+                created_at,
+                run_at,
+                scheduled_at,
+                complete_on,
+                CASE WHEN dropped THEN null ELSE result END,
+                traceback,
+                group_id,
+                queue
+            FROM (
+                SELECT
+                    *,
+                    drop_success AND status = 'success' AS dropped
+                FROM moved
+            ) archive
+            RETURNING 1
+    ) SELECT count(*) FROM moved INTO amount;
+    RETURN amount;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,7 @@
+-- jobs:no-transaction
+--
+-- jobs.archive picks the oldest completions first, built concurrently
+-- to not block acks on a live queue.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_done_complete_on
+    ON jobs.job_done(complete_on);
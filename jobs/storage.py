@@ -0,0 +1,186 @@
+from abc import ABC
+from abc import abstractmethod
+from pathlib import Path
+
+import asyncio
+import asyncpg
+import hashlib
+import json
+import os
+import tempfile
+import time
+import typing
+
+REF = "$ref"
+
+# keys referenced by queued, done or archived jobs
+REFERENCED = """
+    SELECT body->>'$ref' AS key FROM jobs.job_queue
+        WHERE jsonb_typeof(body) = 'object' AND body ? '$ref'
+    UNION
+    SELECT body->>'$ref' FROM jobs.job
+        WHERE jsonb_typeof(body) = 'object' AND body ? '$ref'
+    UNION
+    SELECT result->>'$ref' FROM jobs.job
+        WHERE jsonb_typeof(result) = 'object' AND result ? '$ref'
+    UNION
+    SELECT result->>'$ref' FROM jobs.job_done
+        WHERE jsonb_typeof(result) = 'object' AND result ? '$ref'
+"""
+
+
+def is_reference(value: typing.Any) -> bool:
+    return isinstance(value, dict) and list(value.keys()) == [REF]
+
+
+class PayloadStore(ABC):
+    """Keep large job bodies and results out of the queue rows.
+
+    Payloads bigger than `threshold` bytes are stored once, keyed by
+    their sha256, and replaced by a `{"$ref": key}` reference.
+    Subclasses implement `put`, `get` and `purge`.
+    """
+
+    def __init__(self, threshold: int = 64 * 1024):
+        self.threshold = threshold
+
+    @abstractmethod
+    async def put(self, db: asyncpg.Connection, key: str, data: str):
+        pass
+
+    @abstractmethod
+    async def get(self, db: asyncpg.Connection, key: str) -> str:
+        pass
+
+    @abstractmethod
+    async def purge(self, db: asyncpg.Connection, older_than: float = 3600):
+        """Deletes the payloads no job references anymore.
+
+        Only payloads stored more than `older_than` seconds ago are
+        considered, the ones of jobs being published are not visible yet.
+        Returns the number of deleted payloads.
+        """
+
+    async def offload(self, db: asyncpg.Connection, data: str) -> str:
+        """Returns data, or a reference to it if it's too big"""
+        if not isinstance(data, str):
+            return data
+        raw = data.encode("utf-8")
+        if len(raw) < self.threshold:
+            return data
+        key = hashlib.sha256(raw).hexdigest()
+        await self.put(db, key, data)
+        return json.dumps({REF: key})
+
+    async def load(self, db: asyncpg.Connection, value: typing.Any):
+        """Returns the decoded payload, fetching it if value is a reference"""
+        if is_reference(value):
+            return json.loads(await self.get(db, value[REF]))
+        return value
+
+
+class DBStore(PayloadStore):
+    """Payloads on the `jobs.payload` table, same transaction as the job"""
+
+    async def put(self, db: asyncpg.Connection, key: str, data: str):
+        # reusing a payload refreshes it (and row locks it), so a purge
+        # can't delete it before the new reference is committed
+        await db.execute(
+            "INSERT INTO jobs.payload (id, data) VALUES ($1, $2) "
+            "ON CONFLICT (id) DO UPDATE SET created_at = clock_timestamp()",
+            key,
+            data,
+        )
+
+    async def get(self, db: asyncpg.Connection, key: str) -> str:
+        data = await db.fetchval(
+            "SELECT data FROM jobs.payload WHERE id=$1", key
+        )
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    async def purge(self, db: asyncpg.Connection, older_than: float = 3600):
+        return await db.fetchval(
+            f"""
+            WITH referenced AS ({REFERENCED}), deleted AS (
+                DELETE FROM jobs.payload p
+                WHERE created_at < clock_timestamp() - make_interval(secs=>$1)
+                AND NOT EXISTS (
+                    SELECT 1 FROM referenced r WHERE r.key = p.id
+                )
+                RETURNING 1
+            ) SELECT count(*) FROM deleted
+            """,
+            older_than,
+        )
+
+
+class FileStore(PayloadStore):
+    """Payloads as files on a local (or mounted) directory"""
+
+    def __init__(self, path: typing.Union[str, Path], **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _write(self, key: str, data: str):
+        file = self.path / f"{key}.json"
+        if file.exists():
+            # reused, keep it out of purge until the new job is visible
+            os.utime(file)
+            return
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.path, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp:
+            tmp.write(data)
+        os.replace(tmp.name, file)
+
+    def _read(self, key: str) -> str:
+        file = self.path / f"{key}.json"
+        if not file.exists():
+            raise KeyError(key)
+        return file.read_text(encoding="utf-8")
+
+    def _candidates(self, limit: float) -> typing.List[str]:
+        return [
+            file.stem
+            for file in self.path.glob("*.json")
+            if file.stat().st_mtime < limit
+        ]
+
+    def _delete(self, keys: typing.List[str], limit: float) -> int:
+        deleted = 0
+        for key in keys:
+            file = self.path / f"{key}.json"
+            # reused by a put while the references were checked
+            if file.stat().st_mtime >= limit:
+                continue
+            file.unlink()
+            deleted += 1
+        return deleted
+
+    async def put(self, db: asyncpg.Connection, key: str, data: str):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, key, data)
+
+    async def get(self, db: asyncpg.Connection, key: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read, key)
+
+    async def purge(self, db: asyncpg.Connection, older_than: float = 3600):
+        loop = asyncio.get_running_loop()
+        limit = time.time() - older_than
+        keys = await loop.run_in_executor(None, self._candidates, limit)
+        if not keys:
+            return 0
+        unused = await db.fetch(
+            f"""
+            WITH referenced AS ({REFERENCED})
+            SELECT k FROM unnest($1::varchar[]) AS k
+            WHERE NOT EXISTS (SELECT 1 FROM referenced r WHERE r.key = k)
+            """,
+            keys,
+        )
+        unused = [row["k"] for row in unused]
+        return await loop.run_in_executor(None, self._delete, unused, limit)
@@ -1,10 +1,13 @@
 from .utils import count
+from jobs.storage import DBStore
+from jobs.storage import FileStore
 
 import asyncio
 import asyncpg
 import datetime
 import jobs
 import json
+import os
 import pytest
 
 pytestmark = pytest.mark.asyncio
@@ -12,7 +15,7 @@ pytestmark = pytest.mark.asyncio
 
 async def test_migrations_are_working(db):
     mi = await db.fetchval("select migration from jobs.migrations")
-    assert mi == 1
+    assert mi == 6
 
 
 async def test_jobs_basic_operations(db):
@@ -165,3 +168,214 @@ async def test_consume_topics(db):
 
     t3 = await jobs.consume_topic(db, "task.new.%")
     assert len(t3) == 1
+
+
+async def test_chain_jobs(db):
+    t1 = await jobs.publish(db, "step.1")
+    t2 = await jobs.publish(db, "step.2", depends_on=[t1["job_id"]])
+    assert t2["pending_deps"] == 1
+    [job] = await jobs.consume(db, 2)
+    assert job["job_id"] == t1["job_id"]
+    task = await jobs.get(db, t2["job_id"])
+    assert task["status"] == "waiting"
+
+    await jobs.ack(db, t1["job_id"])
+    [job] = await jobs.consume(db, 1)
+    assert job["job_id"] == t2["job_id"]
+
+
+async def test_chord_jobs(db):
+    group = [
+        await jobs.publish(db, "step.fan", group_id="g1") for _ in range(3)
+    ]
+    callback = await jobs.publish(db, "step.join", after_group="g1")
+    assert callback["pending_deps"] == 3
+
+    tasks = await jobs.consume(db, 10)
+    assert {t["job_id"] for t in tasks} == {t["job_id"] for t in group}
+    for t in tasks[:-1]:
+        await jobs.ack(db, t["job_id"])
+    assert len(await jobs.consume(db, 1)) == 0
+
+    await jobs.ack(db, tasks[-1]["job_id"])
+    [job] = await jobs.consume(db, 1)
+    assert job["job_id"] == callback["job_id"]
+
+
+async def test_chord_after_failed_member(db):
+    ok = await jobs.publish(db, "step.fan", group_id="g2")
+    bad = await jobs.publish(db, "step.fan", group_id="g2", max_retries=1)
+    await jobs.consume(db, 2)
+    await jobs.ack(db, ok["job_id"])
+    callback = await jobs.publish(db, "step.join", after_group="g2")
+    assert callback["pending_deps"] == 1
+
+    await jobs.nack(db, bad["job_id"])
+    assert await count(db, "jobs.job", "group_id = 'g2'") == 2
+    task = await jobs.get(db, callback["job_id"])
+    assert task["status"] == "failed"
+
+    # aborts the test transaction, keep it last
+    with pytest.raises(asyncpg.exceptions.RaiseError):
+        await jobs.publish(db, "step.join", after_group="g2")
+
+
+async def test_failed_dependency_fails_dependents(db):
+    t1 = await jobs.publish(db, "step.1", max_retries=1)
+    t2 = await jobs.publish(db, "step.2", depends_on=[t1["job_id"]])
+    t3 = await jobs.publish(db, "step.3", depends_on=[t2["job_id"]])
+    await jobs.consume(db, 1)
+    await jobs.nack(db, t1["job_id"])
+    assert await count(db, "jobs.job_queue") == 0
+    task = await jobs.get(db, t3["job_id"])
+    assert task["status"] == "failed"
+    assert task["traceback"] == "dependency_failed " + t2["job_id"]
+
+    with pytest.raises(asyncpg.exceptions.RaiseError):
+        await jobs.publish(db, "step.4", depends_on=[t1["job_id"]])
+
+
+async def test_failed_dependency_reached_twice(db):
+    a = await jobs.publish(db, "step.a", max_retries=1)
+    b = await jobs.publish(db, "step.b", depends_on=[a["job_id"]])
+    d = await jobs.publish(db, "step.d", depends_on=[a["job_id"], b["job_id"]])
+    await jobs.consume(db, 1)
+    await jobs.nack(db, a["job_id"])
+    assert await count(db, "jobs.job_queue") == 0
+    assert await count(db, "jobs.job_dependency") == 0
+    assert await count(db, "jobs.job", f"job_id = '{d['job_id']}'") == 1
+    task = await jobs.get(db, d["job_id"])
+    assert task["status"] == "failed"
+
+
+async def test_named_queues(db):
+    t1 = await jobs.publish(db, "task", queue="mails")
+    t2 = await jobs.publish(db, "task")
+    assert t1["queue"] == "mails"
+    assert t2["queue"] == "default"
+
+    [job] = await jobs.consume(db, 10, queue="default")
+    assert job["job_id"] == t2["job_id"]
+    assert len(await jobs.consume(db, 10, queue="default")) == 0
+
+    await jobs.create_queue(db, "mails")
+    assert await count(db, "jobs.job_queue_mails") == 1
+    [job] = await jobs.consume(db, 10, queue="mails")
+    assert job["job_id"] == t1["job_id"]
+
+    finished = await jobs.ack(db, t1["job_id"])
+    assert finished["queue"] == "mails"
+
+
+async def test_consume_topic_on_queue(db):
+    await jobs.publish(db, "task.new.1", queue="reports")
+    t2 = await jobs.publish(db, "task.old.1", queue="reports")
+    await jobs.publish(db, "task.old.2")
+    [job] = await jobs.consume_topic(db, "task.old.%", 10, queue="reports")
+    assert job["job_id"] == t2["job_id"]
+
+
+async def test_deferred_ack_and_archive(db):
+    t1 = await jobs.publish(db, "task")
+    t2 = await jobs.publish(db, "task", depends_on=[t1["job_id"]])
+    await jobs.consume(db, 1)
+    done = await jobs.ack(db, t1["job_id"], '{"ok": 1}', deferred=True)
+    assert done["status"] == "success"
+    assert await count(db, "jobs.job") == 0
+    assert (await jobs.get(db, t1["job_id"]))["status"] == "success"
+    assert await db.fetchval("SELECT count(*) FROM jobs.running") == 0
+
+    # dependents are released on the deferred ack
+    [job] = await jobs.consume(db, 1)
+    assert job["job_id"] == t2["job_id"]
+
+    assert await jobs.archive(db) == 1
+    assert await count(db, "jobs.job_done") == 0
+    finished = await jobs.get(db, t1["job_id"])
+    assert finished["status"] == "success"
+    assert json.loads(finished["result"]) == {"ok": 1}
+
+    # aborts the test transaction, keep it last
+    with pytest.raises(asyncpg.exceptions.RaiseError):
+        await jobs.ack(db, t1["job_id"])
+
+
+async def test_archive_drop_success(db):
+    for _ in range(0, 3):
+        await jobs.publish(db, "task")
+    for task in await jobs.consume(db, 3):
+        await jobs.ack(db, task["job_id"], deferred=True)
+    assert await jobs.archive(db, batch=2, drop_success=True) == 2
+    assert await jobs.archive(db, batch=2, drop_success=True) == 1
+    assert await count(db, "jobs.job_queue") == 0
+    assert await count(db, "jobs.job", condition="result IS NULL") == 3
+
+    # dropped jobs are still done for chaining
+    child = await jobs.publish(db, "task", depends_on=[task["job_id"]])
+    assert child["pending_deps"] == 0
+    finished = await jobs.get(db, task["job_id"])
+    assert finished["status"] == "success"
+    assert finished["body"] is None
+
+
+async def test_small_bodies_stay_inline(db):
+    store = DBStore(threshold=1024)
+    task = await jobs.publish(db, "task", args=[1, 2], store=store)
+    assert json.loads(task["body"]) == {"args": [1, 2], "kwargs": None}
+    assert await count(db, "jobs.payload") == 0
+
+
+async def test_offload_body_and_result(db):
+    store = DBStore(threshold=10)
+    task = await jobs.publish(
+        db, "jobs.tests.task.task", args=[1, 2], store=store
+    )
+    assert list(json.loads(task["body"]).keys()) == ["$ref"]
+    await jobs.publish(db, "jobs.tests.task.task", args=[1, 2], store=store)
+    assert await count(db, "jobs.payload") == 1
+
+    [job] = await jobs.consume(db, 1)
+    result = await jobs.run(db, job, sync=True, store=store)
+    assert result == 3
+    finished = await jobs.get(db, job["job_id"])
+    assert finished["status"] == "success"
+    assert finished["result"] == "3"
+
+
+async def test_purge_unreferenced_payloads(db):
+    store = DBStore(threshold=10)
+    await jobs.publish(db, "task", args=[1, 2], store=store)
+    await store.put(db, "unused", '"data"')
+    assert await store.purge(db, older_than=0) == 1
+    assert await count(db, "jobs.payload") == 1
+
+
+async def test_purge_keeps_reused_payloads(db):
+    store = DBStore(threshold=10)
+    await store.put(db, "shared", '"data"')
+    await db.execute(
+        "UPDATE jobs.payload SET created_at = created_at - interval '2 hours'"
+    )
+    await store.put(db, "shared", '"data"')
+    assert await store.purge(db, older_than=3600) == 0
+    assert await count(db, "jobs.payload") == 1
+
+
+async def test_file_store(db, tmp_path):
+    store = FileStore(tmp_path, threshold=10)
+    await jobs.publish(db, "jobs.tests.task.task", args=[2, 2], store=store)
+    await store.put(db, "unused", '"data"')
+    assert len(list(tmp_path.glob("*.json"))) == 2
+    [job] = await jobs.consume(db, 1)
+    assert await jobs.run(db, job, sync=True, store=store) == 4
+    assert await store.purge(db, older_than=0) == 1
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+
+async def test_file_store_keeps_reused_payloads(db, tmp_path):
+    store = FileStore(tmp_path, threshold=10)
+    await store.put(db, "shared", '"data"')
+    os.utime(tmp_path / "shared.json", (0, 0))
+    await store.put(db, "shared", '"data"')
+    assert await store.purge(db, older_than=3600) == 0
+    assert (tmp_path / "shared.json").exists()
@@ -0,0 +1,73 @@
+from jobs.autoscale import Autoscaler
+from jobs.autoscale import queue_age
+
+import datetime
+import pytest
+
+
+def make_jobs(amount, age=0.0):
+    now = datetime.datetime.utcnow()
+    return [
+        {
+            "created_at": now - datetime.timedelta(seconds=age),
+            "scheduled_at": None,
+            "run_at": now,
+        }
+        for _ in range(0, amount)
+    ]
+
+
+def test_queue_age_counts_from_schedule():
+    now = datetime.datetime.utcnow()
+    job = {
+        "created_at": now - datetime.timedelta(seconds=10),
+        "scheduled_at": now - datetime.timedelta(seconds=2),
+        "run_at": now,
+    }
+    assert queue_age(job) == 2
+
+
+def test_grows_when_backlogged():
+    scaler = Autoscaler(max_batch=8, max_connections=3)
+    for age in range(0, 5):
+        scaler.observe(make_jobs(scaler.batch_size, age=age))
+    assert scaler.batch_size == 8
+    assert scaler.concurrency == 2
+    assert scaler.wait == 0
+
+
+def test_holds_when_backlog_drains():
+    scaler = Autoscaler()
+    scaler.observe(make_jobs(1, age=5))
+    assert scaler.batch_size == 2
+    scaler.observe(make_jobs(2, age=1))
+    assert scaler.batch_size == 2
+
+
+def test_shrinks_and_backs_off_when_idle():
+    scaler = Autoscaler(min_wait=0.1, max_wait=1)
+    scaler.observe(make_jobs(1))
+    scaler.observe(make_jobs(2))
+    scaler.observe(make_jobs(1))
+    assert scaler.batch_size == 1
+    assert scaler.wait == 0.1
+
+    waits = []
+    for _ in range(0, 5):
+        scaler.observe([])
+        waits.append(scaler.wait)
+    assert waits == [0.2, 0.4, 0.8, 1, 1]
+    state = scaler.state()
+    assert state["empty_streak"] == 5
+    assert state["claimed"] == 4
+    assert state["concurrency"] == 1
+    assert state["claim_wait"] == 0
+
+
+def test_split_shares_connections():
+    scalers = Autoscaler(max_batch=8, max_connections=10).split(3)
+    assert [s.max_connections for s in scalers] == [4, 3, 3]
+    assert len({id(s) for s in scalers}) == 3
+    assert all(s.max_batch == 8 for s in scalers)
+    with pytest.raises(ValueError):
+        Autoscaler(max_connections=2).split(3)
@@ -0,0 +1,126 @@
+from jobs.hooks import Histogram
+from jobs.hooks import Hook
+from jobs.hooks import SlowTaskProfiler
+from jobs.hooks import TimingRecorder
+
+import jobs
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+class Recorder(Hook):
+    def __init__(self):
+        self.calls = []
+
+    async def before_run(self, task):
+        self.calls.append("before_run")
+
+    async def after_run(self, task, result, timings):
+        self.calls.append("after_run")
+        self.timings = timings
+
+    async def on_ack(self, task, result):
+        self.calls.append("on_ack")
+
+    async def on_error(self, task, error, timings):
+        self.calls.append("on_error")
+
+
+class Failing(Hook):
+    async def before_run(self, task):
+        raise ValueError()
+
+    async def after_run(self, task, result, timings):
+        raise ValueError()
+
+    async def on_ack(self, task, result):
+        raise ValueError()
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1, float("inf")))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 4
+    assert snapshot["min"] == 0.05
+    assert snapshot["max"] == 3
+    assert snapshot["buckets"] == {0.1: 1, 1: 3, float("inf"): 4}
+
+
+def test_histogram_adds_inf_bucket():
+    histogram = Histogram(buckets=(0.1, 1))
+    histogram.observe(3)
+    assert histogram.snapshot()["buckets"] == {0.1: 0, 1: 0, float("inf"): 1}
+
+
+async def test_run_hooks(db):
+    hook = Recorder()
+    recorder = TimingRecorder()
+    await jobs.publish(db, "jobs.tests.task.task", args=[1, 2])
+    [task] = await jobs.consume(db, 1)
+    result = await jobs.run(db, task, sync=True, hooks=[hook, recorder])
+    assert result == 3
+    assert hook.calls == ["before_run", "on_ack", "after_run"]
+    assert set(hook.timings) == {
+        "resolve",
+        "deserialize",
+        "execute",
+        "serialize",
+        "ack",
+    }
+    assert recorder.snapshot()["execute"]["count"] == 1
+
+
+async def test_failing_hooks_dont_break_jobs(db):
+    await jobs.publish(db, "jobs.tests.task.task", args=[1, 2])
+    [task] = await jobs.consume(db, 1)
+    result = await jobs.run(db, task, sync=True, hooks=[Failing()])
+    assert result == 3
+    finished = await jobs.get(db, task["job_id"])
+    assert finished["status"] == "success"
+
+
+async def test_run_hooks_on_error(db):
+    hook = Recorder()
+    recorder = TimingRecorder()
+    await jobs.publish(db, "jobs.tests.task.unknown")
+    [task] = await jobs.consume(db, 1)
+    await jobs.run(db, task, sync=True, hooks=[hook, recorder])
+    assert hook.calls == ["before_run", "on_error"]
+    assert recorder.errors == 1
+
+
+async def test_slow_task_profiler(db):
+    profiler = SlowTaskProfiler(threshold=0.5)
+    await jobs.publish(db, "jobs.tests.task.long_task", args=[1, 2])
+    await jobs.publish(db, "jobs.tests.task.task", args=[1, 2])
+    for task in await jobs.consume(db, 2):
+        await jobs.run(db, task, sync=True, hooks=[profiler])
+    [report] = profiler.reports
+    assert report["task"] == "jobs.tests.task.long_task"
+    assert report["samples"] > 0
+
+
+async def test_span_emitter(db):
+    pytest.importorskip("opentelemetry.sdk")
+    from jobs.hooks import SpanEmitter
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    emitter = SpanEmitter(provider.get_tracer("test"))
+
+    await jobs.publish(db, "jobs.tests.task.task", args=[1, 2])
+    [task] = await jobs.consume(db, 1)
+    await jobs.run(db, task, sync=True, hooks=[emitter])
+    [span] = exporter.get_finished_spans()
+    assert span.name == "jobs.run jobs.tests.task.task"
+    assert span.attributes["jobs.job_id"] == task["job_id"]
+    assert "jobs.execute" in span.attributes
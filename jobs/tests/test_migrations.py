@@ -0,0 +1,93 @@
+from jobs import migrations
+from jobs.migrations import ChecksumMismatch
+from jobs.migrations import concurrent_indexes
+from jobs.migrations import lock_impact
+from jobs.migrations import migrate
+from jobs.migrations import split_statements
+
+import pytest
+
+SQL = """
+-- a comment; with a semicolon
+create table jobs.x (id integer, name varchar default 'a;b');
+
+create or replace function jobs.f() returns void as $$
+BEGIN
+    DELETE FROM jobs.x;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def test_split_statements():
+    statements = split_statements(SQL)
+    assert len(statements) == 2
+    assert statements[0].endswith("default 'a;b');")
+    assert statements[1].endswith("$$ LANGUAGE plpgsql;")
+
+
+def test_lock_impact():
+    impact = lock_impact("CREATE INDEX CONCURRENTLY idx ON jobs.job(task);")
+    assert impact["lock"] == "SHARE UPDATE EXCLUSIVE"
+    assert impact["relation"] == "jobs.job"
+
+    impact = lock_impact("CREATE index idx ON jobs.job_queue(task);")
+    assert impact["lock"] == "SHARE"
+    assert impact["blocks"] == "writes"
+
+    impact = lock_impact("alter table jobs.job add column queue varchar;")
+    assert impact["lock"] == "ACCESS EXCLUSIVE"
+
+    assert lock_impact("create table jobs.x (id integer);")["lock"] is None
+
+    impact = lock_impact(
+        "create table jobs.job_queue_x partition of jobs.job_queue "
+        "for values in ('x');"
+    )
+    assert impact["lock"] == "ACCESS EXCLUSIVE"
+    assert impact["relation"] == "jobs.job_queue"
+
+    impact = lock_impact("create or replace view jobs.running as (select 1);")
+    assert impact["lock"] == "ACCESS EXCLUSIVE"
+    assert impact["relation"] == "jobs.running"
+    assert lock_impact("drop view jobs.all;")["relation"] == "jobs.all"
+
+    impact = lock_impact("alter sequence jobs.job_number restart;")
+    assert impact["lock"] == "SHARE ROW EXCLUSIVE"
+
+    impact = lock_impact("drop function jobs.consume(integer);")
+    assert impact["lock"] is None
+    assert impact["relation"] is None
+
+    assert lock_impact("grant select on jobs.job to x;")["lock"] == "unknown"
+
+
+def test_concurrent_indexes():
+    sql = """
+    -- jobs:no-transaction
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a ON jobs.job_done(a);
+    CREATE INDEX idx_b ON jobs.job_done(b);
+    """
+    assert concurrent_indexes(sql) == ["jobs.idx_a"]
+
+
+def test_all_migrations_are_splittable():
+    for name in migrations.get_available().values():
+        assert split_statements(migrations.load_migration(name))
+
+
+@pytest.mark.asyncio
+async def test_history_and_dry_run(db):
+    available = migrations.get_available()
+    versions = await db.fetch(
+        "SELECT version FROM jobs.migration_history ORDER BY version"
+    )
+    assert [v["version"] for v in versions] == sorted(available)
+    assert await migrate(db, dry_run=True) == []
+
+
+@pytest.mark.asyncio
+async def test_checksum_mismatch(db, monkeypatch):
+    monkeypatch.setattr(migrations, "load_migration", lambda name: "-- edit")
+    with pytest.raises(ChecksumMismatch):
+        await migrate(db)
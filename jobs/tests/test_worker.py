@@ -1,4 +1,5 @@
 from .utils import count
+from jobs.autoscale import Autoscaler
 from jobs.migrations import migrate
 from jobs.worker import Worker
 
@@ -114,3 +115,25 @@ async def test_server_closes_conn(db_settings):
     await runner
     await db.execute("DROP schema jobs CASCADE;")
     await db.close()
+
+
+async def test_autoscaled_worker(db_settings):
+    host, port = db_settings
+    dsn = f"postgresql://postgres@{host}:{port}/guillotina"
+    db = await asyncpg.connect(dsn)
+    await migrate(db)
+
+    await jobs.publish_bulk(db, create_jobs(100))
+    worker = Worker(dsn, autoscale=Autoscaler(max_connections=4))
+    runner = asyncio.create_task(worker.work())
+
+    processed = 0
+    while processed < 100:
+        processed = await db.fetchval("select count(*) from jobs.job")
+        await asyncio.sleep(0.5)
+
+    assert worker.autoscale.state()["claimed"] == 100
+    worker.close()
+    await runner
+    await db.execute("DROP schema jobs CASCADE;")
+    await db.close()
@@ -28,7 +28,8 @@ setup(
             "pytest-cov",
             "pytest-docker-fixtures[pg]",
             "coverage",
-        ]
+        ],
+        "otel": ["opentelemetry-api"],
     },
     entry_points={
         "console_scripts": [